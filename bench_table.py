@@ -0,0 +1,207 @@
+"""
+路由表的benchmark, 不访问网络, 结果以json输出, 用于不同版本之间比较
+
+python bench_table.py --sizes 10000 100000 1000000 --output result.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import typing
+import argparse
+import platform
+import tracemalloc
+import contextlib
+
+from rtt import RttTable
+from overload import LoadShedder
+from dht import Dht, Bucket, Node, sort_node_list
+
+
+class StubDispatcher:
+    """
+    代替EventDispatcher, 只记录发送的请求数量
+    """
+
+    def __init__(self):
+        self.rtt_table = RttTable()
+        self.shedder = LoadShedder()
+        self.sent = 0
+
+    def send_krpc(self, krpc, sock_addr, callback=None, args=None, sync=False, timeout=None, node_id=None, sock=None,
+                  coalesce=False):
+        self.sent += 1
+
+    def send_response(self, krpc, sock_addr, sock=None):
+        pass
+
+    def add_timer(self, timer):
+        pass
+
+
+def max_rss_bytes() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def random_nodes(count: int) -> typing.Iterator[Node]:
+    # 逐个生成, 没有进入路由表的节点可以被回收, 10^7个节点时不会占用太多内存
+    for i in range(count):
+        node = Node(random.randbytes(20), f"10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}", 6881)
+        node.active()
+        yield node
+
+
+def fill_table(dht: Dht, size: int):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for node in random_nodes(size):
+            dht.join_table(node)
+
+
+def table_node_count(dht: Dht) -> int:
+    return sum(len(bucket.nodes) + len(bucket.caches) for bucket in dht.table)
+
+
+def bench_memory(size: int) -> dict:
+    """
+    用tracemalloc统计填满路由表之后仍然占用的内存(不包括空的Dht本身), 和计时分开运行, 避免影响计时
+    """
+    tracemalloc.start()
+    dht = Dht("0.0.0.0", 0, dispatcher=StubDispatcher())
+    base, _ = tracemalloc.get_traced_memory()
+    fill_table(dht, size)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = table_node_count(dht)
+    return {
+        'table_bytes': current - base,
+        'traced_peak_bytes': peak,
+        'bytes_per_node': (current - base) / max(1, nodes),
+        'max_rss_bytes': max_rss_bytes(),
+    }
+
+
+def percentile(samples: typing.List[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def bench_size(size: int, lookups: int, stale_ratio: float, memory: bool) -> dict:
+    result = {'size': size}
+    dht = Dht("0.0.0.0", 0, dispatcher=StubDispatcher())
+
+    # join_table, 同时统计check_bucket的耗时和分裂次数
+    check_bucket = dht.check_bucket
+    check_time = [0.0, 0]
+
+    def timed_check_bucket(idx: int):
+        table_len = len(dht.table)
+        start = time.perf_counter()
+        check_bucket(idx)
+        if len(dht.table) != table_len:
+            check_time[0] += time.perf_counter() - start
+            check_time[1] += 1
+
+    dht.check_bucket = timed_check_bucket
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for node in random_nodes(size):
+            dht.join_table(node)
+        elapsed = time.perf_counter() - start
+    dht.check_bucket = check_bucket
+
+    table_nodes = sum(len(bucket.nodes) for bucket in dht.table)
+    cache_nodes = sum(len(bucket.caches) for bucket in dht.table)
+    result['join_table'] = {
+        'seconds': elapsed,
+        'inserts_per_second': size / elapsed,
+        'buckets': len(dht.table),
+        'table_nodes': table_nodes,
+        'cache_nodes': cache_nodes,
+    }
+    result['check_bucket_split'] = {
+        'splits': check_time[1],
+        'mean_us': check_time[0] / check_time[1] * 1e6 if check_time[1] else 0,
+    }
+    if memory:
+        result['memory'] = bench_memory(size)
+
+    # find_near_nodes和最近的k个节点
+    near_samples = []
+    closest_samples = []
+    compact_samples = []
+    for _ in range(lookups):
+        target = random.randbytes(20)
+        start = time.perf_counter()
+        near_node_list = dht.find_near_nodes(target)
+        near_samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sort_node_list(near_node_list, target, dht.dispatcher.rtt_table)
+        closest_samples.append(time.perf_counter() - start + near_samples[-1])
+
+        start = time.perf_counter()
+        dht.find_near_nodes_compact(target)
+        compact_samples.append(time.perf_counter() - start)
+
+    for name, samples in (('find_near_nodes', near_samples), ('closest_k', closest_samples),
+                          ('find_near_nodes_compact', compact_samples)):
+        result[name] = {
+            'mean_us': sum(samples) / len(samples) * 1e6,
+            'p50_us': percentile(samples, 0.5) * 1e6,
+            'p99_us': percentile(samples, 0.99) * 1e6,
+        }
+
+    # update_bucket, stale_ratio比例的节点超过INACTIVE_TIME没有活跃
+    expired_time = time.time() - Node.INACTIVE_TIME - 1
+    all_nodes = [node for bucket in dht.table for node in bucket.nodes.values()]
+    for node in random.sample(all_nodes, int(len(all_nodes) * stale_ratio)):
+        node._last_time = expired_time
+    dht.seen_index.compact()
+
+    queued = len(dht.ping_scheduler)
+    start = time.perf_counter()
+    dht.update_bucket()
+    result['update_bucket'] = {
+        'seconds': time.perf_counter() - start,
+        'queued': len(dht.ping_scheduler) - queued,
+        'stale_ratio': stale_ratio,
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="routing table benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help="插入的节点数量, 例如 10000 100000 1000000 10000000")
+    parser.add_argument('--bucket-k', type=int, default=Bucket.K, help="K桶容量, 调大可以让路由表保存更多节点")
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--stale-ratio', type=float, default=0.1)
+    parser.add_argument('--no-memory', action='store_true', help="不统计内存, tracemalloc会额外填充一次路由表")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="json结果写入文件, 默认输出到stdout")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    Bucket.K = args.bucket_k
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'bucket_k': args.bucket_k,
+        'results': [bench_size(size, args.lookups, args.stale_ratio, not args.no_memory) for size in args.sizes],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
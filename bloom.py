@@ -0,0 +1,77 @@
+import math
+import time
+import hashlib
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))  # bit数
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, item: bytes):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, item: bytes):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (0x80 >> (pos & 7)):
+                return False
+        return True
+
+    def add(self, item: bytes):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter:
+    """
+    两代BloomFilter轮换的近似集合: 新元素写入current, 查询同时查current和previous。
+    current写满capacity个元素或者超过rotate_interval秒后丢弃previous, current变成previous,
+    所以元素大约在rotate_interval ~ 2 * rotate_interval秒后被遗忘, 内存固定为两个BloomFilter。
+    每一代的误判率为error_rate / 2, 两代合起来的误判率不超过error_rate
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, rotate_interval=10 * 60):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rotate_interval = rotate_interval
+        self.current = BloomFilter(capacity, error_rate / 2)
+        self.previous = BloomFilter(capacity, error_rate / 2)
+        self._rotate_time = time.time()
+
+    def __str__(self):
+        memory = len(self.current.bits) + len(self.previous.bits)
+        return f"RotatingBloomFilter(current: {len(self.current)}, previous: {len(self.previous)}, memory: {memory})"
+
+    def rotate(self):
+        self.previous = self.current
+        self.current = BloomFilter(self.capacity, self.error_rate / 2)
+        self._rotate_time = time.time()
+
+    def __contains__(self, item: bytes):
+        return item in self.current or item in self.previous
+
+    def add(self, item: bytes) -> bool:
+        """
+        :return: item之前不在集合中返回True
+        """
+        if item in self.current:
+            return False
+
+        if len(self.current) >= self.capacity or time.time() - self._rotate_time >= self.rotate_interval:
+            self.rotate()
+
+        is_new = item not in self.previous
+        self.current.add(item)
+        return is_new
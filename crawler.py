@@ -0,0 +1,182 @@
+import sys
+import time
+import random
+import typing
+from collections import deque, OrderedDict
+
+from krpc import Krpc
+from event import KrpcEvent, EventType, Timer
+from rate_limit import TokenBucket
+from overload import Priority
+from bloom import RotatingBloomFilter
+from dht import Dht, Node, NodeLookup
+
+
+class HashSink:
+    """
+    新发现的info_hash按批写入sink
+    """
+
+    def write(self, info_hash_list: typing.List[bytes]):
+        pass
+
+    def flush(self):
+        pass
+
+
+class PrintSink(HashSink):
+    def write(self, info_hash_list: typing.List[bytes]):
+        for info_hash in info_hash_list:
+            print("info_hash: ", info_hash.hex())
+
+
+class FileSink(HashSink):
+    def __init__(self, path: str):
+        self._file = open(path, 'a')
+
+    def write(self, info_hash_list: typing.List[bytes]):
+        self._file.write(''.join(info_hash.hex() + '\n' for info_hash in info_hash_list))
+
+    def flush(self):
+        self._file.flush()
+
+
+class Crawler:
+    """
+    info_hash收集模式:
+    按顺序遍历keyspace, 向节点发送sample_infohashes(BEP 51)请求, 同一个节点在它返回的interval之内不会重复请求;
+    同时记录收到的get_peers/announce_peer请求中的info_hash。
+    新发现的info_hash攒够batch_size个或者每flush_interval秒写入一次sink, 出站请求不超过max_qps
+    """
+
+    def __init__(self, dht: Dht, sink: HashSink, max_qps=200, batch_size=100, flush_interval=5,
+                 queue_size=10000, max_visit=100000):
+        self._dht = dht
+        self.sink = sink
+        self.budget = TokenBucket(max_qps, max_qps)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: typing.Deque[Node] = deque(maxlen=queue_size)  # 待访问的节点
+        self.next_visit: typing.OrderedDict[tuple, float] = OrderedDict()  # addr -> 下次可以访问的时间
+        self.max_visit = max_visit
+        # 已经发现的info_hash, 和最近加入过队列的节点地址
+        self.known = RotatingBloomFilter(capacity=1000000, error_rate=0.0001, rotate_interval=6 * 3600)
+        self.visited = RotatingBloomFilter(capacity=100000, error_rate=0.001, rotate_interval=5 * 60)
+        self.batch: typing.List[bytes] = []
+        self._cursor = 0  # 遍历keyspace的位置, target的前16位
+        self._lookup: NodeLookup or None = None
+
+        self.sent = 0
+        self.found = 0
+        self.hashes_per_second = 0.0
+        self._last_found = 0
+        self._last_report = time.time()
+
+    def __str__(self):
+        return f"Crawler(found: {self.found}, {self.hashes_per_second:.1f} hashes/s, sent: {self.sent}, " \
+               f"queue: {len(self.queue)})"
+
+    def start(self):
+        self._dht.info_hash_listeners.append(self.on_info_hash)
+        dispatcher = self._dht.dispatcher
+
+        timer = Timer(0.1, lambda x: self.tick(), oneshot=False, name='crawler_tick')
+        timer.start()
+        dispatcher.add_timer(timer)
+
+        timer = Timer(self.flush_interval, lambda x: self.flush(), oneshot=False, name='crawler_flush')
+        timer.start()
+        dispatcher.add_timer(timer)
+
+        timer = Timer(10, lambda x: self.report(), oneshot=False, name='crawler_report')
+        timer.start()
+        dispatcher.add_timer(timer)
+
+    def next_target(self) -> bytes:
+        self._cursor = (self._cursor + 1) % (1 << 16)
+        return self._cursor.to_bytes(2, 'big') + random.randbytes(18)
+
+    def can_visit(self, node: Node, now: float) -> bool:
+        return self.next_visit.get(node.addr(), 0) <= now
+
+    def set_next_visit(self, node: Node, interval: float):
+        addr = node.addr()
+        self.next_visit[addr] = time.time() + interval
+        self.next_visit.move_to_end(addr)
+        while len(self.next_visit) > self.max_visit:
+            self.next_visit.popitem(last=False)
+
+    def enqueue(self, node_list: typing.Iterable[Node]):
+        now = time.time()
+        for node in node_list:
+            if self.can_visit(node, now) and self.visited.add(node.to_bytes()[20:]):
+                self.queue.append(node)
+
+    def refill(self):
+        # 队列空了, 从路由表和一次随机查找中补充节点
+        self.enqueue(self._dht.find_near_nodes(self.next_target()))
+        if self._lookup is None or self._lookup.done:
+            self._lookup = self._dht.lookup_node(random.randbytes(20), lambda lookup: self.enqueue(lookup.closest()))
+
+    def tick(self):
+        if not self._dht.dispatcher.shedder.admit(Priority.LOW):
+            return
+        if not self.queue:
+            self.refill()
+
+        now = time.time()
+        while self.queue and self.budget.allow():
+            node = self.queue.popleft()
+            if not self.can_visit(node, now):
+                continue
+            self.set_next_visit(node, 60)  # 等待响应返回真正的interval
+            packet = self._dht.KrpcRequest.sample_infohashes(self.next_target())
+            self._dht.dispatcher.send_krpc(packet, node.addr(), self.on_response, node)
+            self.sent += 1
+
+    def on_response(self, ev: KrpcEvent, node: Node):
+        if ev.event_type == EventType.EVENT_RESPONSE:
+            try:
+                response: dict = ev.remote_krpc.json()[b'r']
+                samples: bytes = response.get(b'samples', b'')
+                for pos in range(0, len(samples) - 19, 20):
+                    self.add_info_hash(samples[pos:pos + 20])
+                self.set_next_visit(node, response.get(b'interval', 0))
+                self.enqueue(Node.node_list_from_bytes(response.get(b'nodes', b'')))
+            except Exception as e:
+                print(e)
+        elif ev.event_type == EventType.EVENT_ERROR:
+            self.set_next_visit(node, 30 * 60)  # 不支持BEP 51的节点
+        self.tick()
+
+    def on_info_hash(self, info_hash: bytes, krpc: Krpc):
+        self.add_info_hash(info_hash)
+
+    def add_info_hash(self, info_hash: bytes):
+        if not self.known.add(info_hash):
+            return
+        self.found += 1
+        self.batch.append(info_hash)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.sink.write(self.batch)
+            self.batch = []
+        self.sink.flush()
+
+    def report(self):
+        now = time.time()
+        self.hashes_per_second = (self.found - self._last_found) / (now - self._last_report)
+        self._last_found = self.found
+        self._last_report = now
+        print(self)
+
+
+if __name__ == '__main__':
+    dht = Dht("0.0.0.0", 42892)
+    crawler_sink = FileSink(sys.argv[1]) if len(sys.argv) > 1 else PrintSink()
+    crawler = Crawler(dht, crawler_sink)
+    crawler.start()
+    dht.run()
@@ -1,4 +1,5 @@
 import enum
+import heapq
 import socket
 import random
 import time
@@ -8,8 +9,14 @@ from struct import unpack, pack
 from functools import partial
 from collections import OrderedDict
 
-from krpc import Krpc, KrpcRequest
+from krpc import Krpc, KrpcRequest, TokenManager
+from peer_store import PeerStore, compact_peer
+from bloom import RotatingBloomFilter
+from rtt import RttTable
+from lookup_cache import LookupCache
 from event import EventDispatcher, Event, KrpcEvent, EventProcessor, Timer, EventType
+from overload import Priority
+from table_feed import TableFeed, ChangeType
 
 """
 参考
@@ -25,10 +32,20 @@ TODO:
 
 
 def random_node_id() -> bytes:
-    random.seed(time.time())
     return random.randbytes(20)
 
 
+def spread_node_ids(count: int) -> typing.List[bytes]:
+    """
+    生成count个均匀分布在keyspace中的node_id, 前16位等分, 其余位随机
+    """
+    node_id_list = []
+    for i in range(count):
+        prefix = (i << 16) // count
+        node_id_list.append(prefix.to_bytes(2, 'big') + random.randbytes(18))
+    return node_id_list
+
+
 def load_self_node_id() -> bytes:
     return bytes.fromhex("2202030405060708090001020304050607080900")
     # return b'0123456789helloworld'
@@ -92,12 +109,17 @@ class NodeState(enum.Enum):
 
 
 class Node:
+    MAX_FAIL = 3  # 连续超时次数达到MAX_FAIL后节点视为DEAD
+    INACTIVE_TIME = 15 * 60
+
     def __init__(self, node_id: bytes, ip: str, port: int):
         self.node_id = node_id
         self.ip = ip
         self.port = port
         self._state = NodeState.DEAD
         self._last_time = 0
+        self.fail_count = 0
+        self._seen_index: LastSeenIndex or None = None
 
     def __eq__(self, other):
         return self.node_id == other.node_id
@@ -111,12 +133,23 @@ class Node:
     def active(self):
         self._last_time = time.time()
         self._state = NodeState.ACTIVE
+        self.fail_count = 0
+        if self._seen_index is not None:
+            self._seen_index.touch(self)
+
+    def failed(self):
+        self.fail_count += 1
 
     def get_state(self) -> NodeState:
+        """
+        ACTIVE: 15分钟内有响应且没有超时
+        INACTIVE: 超过15分钟没有响应或者最近有超时, 需要ping确认
+        DEAD: 连续超时MAX_FAIL次
+        """
         inactive_time = time.time() - self._last_time
-        if inactive_time > 60 * 20:
+        if self.fail_count >= self.MAX_FAIL:
             self._state = NodeState.DEAD
-        elif inactive_time > 60 * 15:
+        elif self.fail_count > 0 or inactive_time > self.INACTIVE_TIME:
             self._state = NodeState.INACTIVE
         else:
             self._state = NodeState.ACTIVE
@@ -153,6 +186,61 @@ class Node:
         return f"Node(node_id: {node_id}, addr: {self.ip}:{self.port})"
 
 
+class LastSeenIndex:
+    """
+    路由表中节点按最后活跃时间(_last_time)排序的小顶堆, Node.active()时插入新的记录,
+    旧记录在弹出时惰性丢弃。维护时只需要访问过期的前缀, 复杂度与过期节点数成正比
+    """
+
+    def __init__(self):
+        self._nodes: typing.Dict[bytes, Node] = {}
+        self._heap: typing.List[typing.Tuple[float, bytes]] = []
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node_id: bytes):
+        return node_id in self._nodes
+
+    def add(self, node: Node):
+        if node.node_id in self._nodes:
+            return
+        self._nodes[node.node_id] = node
+        node._seen_index = self
+        self.touch(node)
+
+    def remove(self, node: Node):
+        if self._nodes.pop(node.node_id, None) is not None:
+            node._seen_index = None
+
+    def touch(self, node: Node):
+        heapq.heappush(self._heap, (node._last_time, node.node_id))
+        if len(self._heap) > 2 * len(self._nodes) + 64:
+            self.compact()
+
+    def compact(self):
+        self._heap = [(node._last_time, node_id) for node_id, node in self._nodes.items()]
+        heapq.heapify(self._heap)
+
+    def _valid(self, last_time: float, node_id: bytes) -> bool:
+        node = self._nodes.get(node_id)
+        return node is not None and node._last_time == last_time
+
+    def expired(self, deadline: float) -> typing.List[Node]:
+        """
+        返回_last_time早于deadline的节点, 这些节点仍然留在索引中, 直到再次活跃或者被移除
+        """
+        expired_entries = []
+        while self._heap and self._heap[0][0] < deadline:
+            entry = heapq.heappop(self._heap)
+            if self._valid(*entry) and (not expired_entries or expired_entries[-1] != entry):
+                expired_entries.append(entry)
+
+        for entry in expired_entries:
+            heapq.heappush(self._heap, entry)
+        return [self._nodes[node_id] for _, node_id in expired_entries]
+
+
 def distance_metric(node1: bytes or Node, node2: bytes or Node):
     id1 = node1.node_id if isinstance(node1, Node) else node1
     id2 = node2.node_id if isinstance(node2, Node) else node2
@@ -162,9 +250,18 @@ def distance_metric(node1: bytes or Node, node2: bytes or Node):
     return i1 ^ i2
 
 
-def sort_node_list(node_list: typing.List[Node], target_id: bytes):
+def sort_node_list(node_list: typing.List[Node], target_id: bytes, rtt_table: RttTable or None = None):
+    """
+    :param rtt_table: 不为空时, 距离在同一个K桶范围内(异或距离的最高位相同)的节点, RTT小的排在前面
+    """
     distance_cmp = partial(distance_metric, target_id)
-    node_list.sort(key=distance_cmp)
+    if rtt_table is None:
+        node_list.sort(key=distance_cmp)
+    else:
+        def rtt_cmp(node: Node):
+            distance = distance_cmp(node)
+            return distance.bit_length(), rtt_table.rtt(node.addr()), distance
+        node_list.sort(key=rtt_cmp)
 
 
 class DhtBase(EventProcessor):
@@ -174,6 +271,21 @@ class DhtBase(EventProcessor):
     def ping_node(self, node: Node):
         pass
 
+    def ping_nodes(self, node_list: typing.List[Node]):
+        pass
+
+    def lookup_node(self, target_node: bytes, callback: typing.Callable or None = None):
+        pass
+
+    def node_added(self, node: Node):
+        pass
+
+    def node_removed(self, node: Node):
+        pass
+
+    def node_updated(self, node: Node):
+        pass
+
 
 class Bucket:
     K = 8
@@ -203,6 +315,7 @@ class Bucket:
         self.power: int = power
         self._last_change = 0
         self._dht: DhtBase = dht
+        self._compact_nodes: bytes or None = None  # nodes的compact格式缓存, nodes变化时失效
 
     def __str__(self):
         start = self.node_start.hex()
@@ -230,7 +343,7 @@ class Bucket:
             return False
 
     def fork(self) -> typing.Tuple:
-        self_id = load_self_node_id()
+        self_id = self._dht.self_node_id
         node_start_left = copy.copy(self.node_start)
         node_start_right = copy.copy(self.node_start)
         bit = bytes_get_bit(self_id, self.index)
@@ -253,63 +366,332 @@ class Bucket:
 
         if node.node_id in self.nodes:
             self.nodes[node.node_id].active()
+            self._dht.node_updated(self.nodes[node.node_id])
+            return
+
+        if node.node_id in self.caches:
+            self.caches[node.node_id].active()
+            self.caches.move_to_end(node.node_id)
             return
 
         if len(self.nodes) < self.capacity(client_node_id):
             self.nodes[node.node_id] = node
             self.nodes.move_to_end(node.node_id)
+            self._compact_nodes = None
+            self._dht.node_added(node)
         else:
             self.caches[node.node_id] = node
             self.caches.move_to_end(node.node_id)
             self.clear_caches()
+            self._dht.node_removed(node)  # 分裂的时候节点可能从nodes挪到caches
 
     def clear_caches(self):
         while len(self.caches) > 16:
-            self.caches.popitem()
-
-    def update_all(self):
-        self.check_node_state()
-        self.check_update()
-
-    def check_node_state(self):
-        for node_id, node in self.nodes.items():
-            state: NodeState = node.get_state()
-            if state == NodeState.DEAD:
-                self.nodes.pop(node_id)
-                if self.caches:
-                    cache_id, cache_node = self.caches.popitem(last=True)
-                    self.nodes[cache_id] = cache_node
-            elif state == NodeState.INACTIVE:
-                self._dht.ping_node(node)
-            else:
-                pass
+            self.caches.popitem(last=False)
+
+    def remove_node(self, node_id: bytes):
+        """
+        移除节点, 并用caches中最新鲜的节点替换
+        """
+        node = self.nodes.pop(node_id, None)
+        if node is None:
+            return
+        self._last_change = time.time()
+        self._compact_nodes = None
+        self._dht.node_removed(node)
+        if self.caches:
+            cache_id, cache_node = self.caches.popitem(last=True)
+            self.nodes[cache_id] = cache_node
+            self._dht.node_added(cache_node)
+
+    def compact_nodes(self) -> bytes:
+        if self._compact_nodes is None:
+            self._compact_nodes = b''.join(node.to_bytes() for node in self.nodes.values())
+        return self._compact_nodes
+
+    def node_failed(self, node_id: bytes):
+        node = self.nodes.get(node_id)
+        if node is None:
+            self.caches.pop(node_id, None)
+            return
+        node.failed()
+        if node.get_state() == NodeState.DEAD:
+            self.remove_node(node_id)
+        else:
+            self._dht.node_updated(node)
 
-    def check_update(self):
-        if self._last_change + 15 * 60 > time.time():
-            pass
+    def need_update(self, idle_time=15 * 60) -> bool:
+        return self._last_change + idle_time <= time.time()
 
+    def update_target(self) -> bytes:
         if not self.nodes:
             node_id_int = int.from_bytes(self.node_start, byteorder='big', signed=False)
             node_id_int += 1 << (self.power - 1)
-            node_id = node_id_int.to_bytes(20, 'big', signed=False)
+            return node_id_int.to_bytes(20, 'big', signed=False)
         else:
             node_list = list(self.nodes.keys())
-            node_id = random.choice(node_list)
+            return random.choice(node_list)
+
+
+class NodeLookup:
+    """
+    非阻塞的迭代find_node查找, 由dispatcher的回调推进, 结束后调用 callback(lookup)
+    每次最多同时向alpha个节点发送请求, 当距离target最近的k个节点都已经响应时查找结束
+    """
+    ALPHA = 3
+
+    def __init__(self, dht: DhtBase, target: bytes, callback: typing.Callable or None = None, k=8, alpha=ALPHA,
+                 use_cache=True):
+        self._dht = dht
+        self.use_cache: bool = use_cache
+        self.target: bytes = target
+        self.k: int = k
+        self.alpha: int = alpha
+        self._callback = callback
+        self.candidates: typing.Dict[bytes, Node] = {}  # 未失败的候选节点
+        self.queried: typing.Set[bytes] = set()
+        self.responded: typing.Dict[bytes, Node] = {}
+        self.inflight: int = 0
+        self.done: bool = False
+        self.from_cache: bool = False
+
+    def start(self):
+        cached = self._dht.lookup_cache.get(self.target) if self.use_cache else None
+        if cached is not None:
+            # 最近查找过同一个target, 直接使用缓存的结果
+            self.responded = {node.node_id: node for node in cached}
+            self.from_cache = True
+            self.finish()
+            return
+        self.add_candidates(self._dht.find_near_nodes(self.target), seed=True)
+        self.step()
+
+    def add_candidates(self, node_list: typing.Iterable[Node], seed=False):
+        """
+        :param seed: 路由表中的节点总是会被查询; 其他节点如果最近超时过, 则跳过
+        """
+        for node in node_list:
+            if node.node_id == self._dht.self_node_id:
+                continue
+            if node.node_id in self.candidates or node.node_id in self.queried:
+                continue
+            if not seed and node.node_id in self._dht.unresponsive:
+                continue
+            self.candidates[node.node_id] = node
+
+    def closest(self) -> typing.List[Node]:
+        node_list = list(self.responded.values())
+        sort_node_list(node_list, self.target)
+        return node_list[:self.k]
+
+    def create_query(self) -> KrpcRequest:
+        return self._dht.KrpcRequest.find_node(self.target)
+
+    def send_query(self, node: Node):
+        self.queried.add(node.node_id)
+        self.inflight += 1
+        packet = self.create_query()
+        self._dht.dispatcher.send_krpc(packet, node.addr(), self.on_event, node, node_id=node.node_id, coalesce=True)
+
+    def process_response(self, node: Node, response: dict):
+        nodes = response.get(b'nodes')
+        if nodes:
+            self.add_candidates(Node.node_list_from_bytes(nodes))
+
+    def on_event(self, ev: KrpcEvent, node: Node):
+        self.inflight -= 1
+        if ev.event_type == EventType.EVENT_RESPONSE:
+            self.responded[node.node_id] = node
+            try:
+                self.process_response(node, ev.remote_krpc.json()[b'r'])
+            except Exception as e:
+                print(e)
+        else:
+            self.candidates.pop(node.node_id, None)
+        self.step()
 
-        self._dht.find_node(node_id)
+    def step(self):
+        if self.done:
+            return
+
+        node_list = list(self.candidates.values())
+        sort_node_list(node_list, self.target, self._dht.dispatcher.rtt_table)
+        for node in node_list[:self.k]:
+            if self.inflight >= self.alpha:
+                break
+            if node.node_id not in self.queried:
+                self.send_query(node)
+
+        if self.inflight == 0:
+            self.finish()
+
+    def converged(self) -> bool:
+        # 结束时失败的节点已经从候选中移除, 最近的k个候选节点都响应了, 只要响应的节点足够k个
+        return len(self.responded) >= self.k
+
+    def finish(self):
+        self.done = True
+        # 缓存命中时不再写回, 否则常用的target永远不会过期
+        if not self.from_cache and self.converged():
+            self._dht.lookup_cache.put(self.target, self.closest())
+        if self._callback:
+            self._callback(self)
+
+
+class GetPeersLookup(NodeLookup):
+    """
+    迭代get_peers查找, 任何节点返回values时立即调用 on_peers(peer_list), 不等待查找结束,
+    查找继续向info_hash收敛, 收集最近节点返回的token, 用于之后的announce_peer。
+    为了缩短得到第一个peer的时间, 本地peer_store中已有的peer会立即返回, 第一轮同时查询所有初始节点
+    """
+    FIRST_ALPHA = 8
+
+    def __init__(self, dht: DhtBase, info_hash: bytes, on_peers: typing.Callable,
+                 callback: typing.Callable or None = None, k=8, alpha=NodeLookup.ALPHA):
+        super().__init__(dht, info_hash, callback, k, alpha)
+        self.on_peers = on_peers
+        self.peers: typing.Set[bytes] = set()  # compact格式的peer
+        self.tokens: typing.Dict[bytes, bytes] = {}  # node_id -> token
+
+    def start(self):
+        # get_peers需要向节点收集peer和token, 缓存的结果只作为初始节点
+        self.add_peers(self._dht.peer_store.get_peers(self.target))
+        self.add_candidates(self._dht.lookup_cache.get(self.target) or [], seed=True)
+        self.add_candidates(self._dht.find_near_nodes(self.target), seed=True)
+        alpha = self.alpha
+        self.alpha = max(alpha, self.FIRST_ALPHA)
+        self.step()
+        self.alpha = alpha
+
+    def create_query(self) -> KrpcRequest:
+        return self._dht.KrpcRequest.get_peers(self.target)
+
+    def process_response(self, node: Node, response: dict):
+        token = response.get(b'token')
+        if token:
+            self.tokens[node.node_id] = token
+        values = response.get(b'values')
+        if values:
+            self.add_peers(values)
+        super().process_response(node, response)
+
+    def add_peers(self, values: typing.List[bytes]):
+        new_peers = [peer for peer in values if isinstance(peer, bytes) and len(peer) == 6 and peer not in self.peers]
+        if new_peers:
+            self.peers.update(new_peers)
+            self.on_peers(new_peers)
+
+    def announce_nodes(self) -> typing.List[typing.Tuple[Node, bytes]]:
+        return [(node, self.tokens[node.node_id]) for node in self.closest() if node.node_id in self.tokens]
+
+
+class RefreshScheduler:
+    """
+    K桶刷新调度: 只刷新空闲时间超过idle_time的K桶, 刷新时间在spread秒内随机抖动,
+    避免所有K桶同时刷新, 同时进行的刷新不超过max_running个
+    """
+
+    def __init__(self, dht: DhtBase, idle_time=15 * 60, spread=60, max_running=2):
+        self._dht = dht
+        self.idle_time = idle_time
+        self.spread = spread
+        self.max_running = max_running
+        self.pending: typing.Dict[Bucket, float] = {}  # bucket -> 计划刷新时间
+        self.running: typing.Set[Bucket] = set()
+
+    def tick(self):
+        if not self._dht.dispatcher.shedder.admit(Priority.LOW):
+            return
+        now = time.time()
+        table = self._dht.table
+        for bucket in table:
+            if bucket in self.pending or bucket in self.running:
+                continue
+            if bucket.need_update(self.idle_time):
+                self.pending[bucket] = now + random.uniform(0, self.spread)
+
+        for bucket, due in sorted(self.pending.items(), key=lambda item: item[1]):
+            if due > now or len(self.running) >= self.max_running:
+                break
+            self.pending.pop(bucket)
+            if bucket not in table:  # K桶已经分裂
+                continue
+            self.running.add(bucket)
+            bucket._last_change = now
+            self._dht.lookup_node(bucket.update_target(), partial(self.refresh_done, bucket))
+
+    def refresh_done(self, bucket: Bucket, _lookup: NodeLookup):
+        self.running.discard(bucket)
+
+
+class PingScheduler:
+    """
+    需要确认是否活跃的节点排队ping, 每次tick最多发送batch_size个, 避免update_bucket一次ping所有过期节点。
+    同一个节点只排队一次, 发送前已经离开路由表的节点不再ping
+    """
+
+    def __init__(self, dht: DhtBase, batch_size=32):
+        self._dht = dht
+        self.batch_size = batch_size
+        self.queue: typing.OrderedDict[bytes, Node] = OrderedDict()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, node_list: typing.Iterable[Node]):
+        for node in node_list:
+            self.queue.setdefault(node.node_id, node)
+
+    def tick(self):
+        sent = 0
+        while self.queue and sent < self.batch_size:
+            node_id, node = self.queue.popitem(last=False)
+            if node_id not in self._dht.seen_index:
+                continue
+            self._dht.ping_node(node)
+            sent += 1
 
 
 class Dht(DhtBase):
     K = 8
 
-    def __init__(self, local_ip, local_port):
-        self.self_node_id = load_self_node_id()
-        self.dispatcher = EventDispatcher(self, local_ip, local_port)
-        self.KrpcRequest = KrpcRequest
-        self.KrpcRequest.init_class(self.self_node_id)
+    def __init__(self, local_ip, local_port, dispatcher: EventDispatcher or None = None,
+                 node_id: bytes or None = None, share: DhtBase or None = None):
+        """
+        :param dispatcher: 不为空时使用这个dispatcher, 不创建socket(例如benchmark中的假dispatcher, 或者DhtGroup共用的dispatcher)
+        :param node_id: 为空时使用load_self_node_id()
+        :param share: 和另一个Dht共用与node_id无关的数据(token, peer_store, 查找缓存等), 每增加一个node_id只增加路由表的内存
+        """
+        self.self_node_id = node_id or load_self_node_id()
+        self.dispatcher = dispatcher or EventDispatcher(self, local_ip, local_port)
+        # 每个node_id一个KrpcRequest子类, 发出的请求带上自己的node_id, 响应和超时通过owner找回这个Dht
+        self.KrpcRequest = type('KrpcRequest', (KrpcRequest,), {'_self_node_id': self.self_node_id, 'owner': self})
         self.table: typing.List[Bucket] = []
         first_bucket = Bucket(self, b'\0' * 20, 0, 160)
         self.table.append(first_bucket)
+        self.refresh_scheduler = RefreshScheduler(self)
+        self.ping_scheduler = PingScheduler(self)
+        self.seen_index = LastSeenIndex()
+        self.table_feed = TableFeed()
+        if share is None:
+            self.token_manager = TokenManager()
+            self.unresponsive = RotatingBloomFilter(capacity=50000, error_rate=0.001)  # 最近请求超时的node_id
+            self.lookup_cache = LookupCache()
+            self.peer_store = PeerStore()
+            # listener(info_hash, krpc), 收到get_peers/announce_peer请求时调用
+            self.info_hash_listeners: typing.List[typing.Callable] = []
+        else:
+            self.token_manager = share.token_manager
+            self.unresponsive = share.unresponsive
+            self.lookup_cache = share.lookup_cache
+            self.peer_store = share.peer_store
+            self.info_hash_listeners = share.info_hash_listeners
+        self.request_handlers: typing.Dict[bytes, typing.Callable] = {
+            b'ping': self.on_ping,
+            b'find_node': self.on_find_node,
+            b'get_peers': self.on_get_peers,
+            b'announce_peer': self.on_announce_peer,
+        }
 
     def check_bucket(self, idx: int):
         bucket = self.table[idx]
@@ -326,13 +708,19 @@ class Dht(DhtBase):
             self.table.append(bucket1)
             self.table.append(bucket2)
 
-    def join_table(self, node: Node):
+    def find_bucket_index(self, node_id: bytes) -> int:
         for idx, bucket in enumerate(self.table):
-            if bucket.in_range(node.node_id):
-                bucket.add_node(node, self.self_node_id)
-                self.check_bucket(idx)
-                print("node_join_table: ", node)
-                return
+            if bucket.in_range(node_id):
+                return idx
+        return -1
+
+    def join_table(self, node: Node):
+        idx = self.find_bucket_index(node.node_id)
+        if idx >= 0:
+            self.table[idx].add_node(node, self.self_node_id)
+            self.check_bucket(idx)
+            print("node_join_table: ", node)
+            return
         print("ERROR: join_dht")
         print("node", node)
         for idx, bucket in enumerate(self.table):
@@ -340,8 +728,11 @@ class Dht(DhtBase):
         print("=======================END=============")
 
     def response_join_table(self, krpc: Krpc):
-        krpc_dict = krpc.json()
-        node_id: bytes = krpc_dict[b'r'][b'id']
+        response = krpc.json().get(b'r')
+        node_id = response.get(b'id') if isinstance(response, dict) else None
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            print("invalid response: ", krpc.sender_ip, krpc.sender_port)
+            return
         node_ip = krpc.sender_ip
         node_port = krpc.sender_port
 
@@ -365,20 +756,116 @@ class Dht(DhtBase):
             return
         print('receive ping response: ', ev.event_type, ev.remote_krpc.sender_ip)
 
+    def on_ping(self, krpc: Krpc, args: dict) -> Krpc:
+        return krpc.ping_response(self.self_node_id)
+
+    def on_find_node(self, krpc: Krpc, args: dict) -> Krpc:
+        return krpc.find_node_response(self.find_near_nodes_compact(args[b'target']), self.self_node_id)
+
+    def notify_info_hash(self, info_hash: bytes, krpc: Krpc):
+        for listener in self.info_hash_listeners:
+            listener(info_hash, krpc)
+
+    def on_get_peers(self, krpc: Krpc, args: dict) -> Krpc:
+        info_hash: bytes = args[b'info_hash']
+        if not isinstance(info_hash, bytes) or len(info_hash) != 20:
+            return krpc.create_error_response(203, "bad info_hash")
+        self.notify_info_hash(info_hash, krpc)
+        token = self.token_manager.token(krpc.sender_ip)
+        values = self.peer_store.get_peers(info_hash)
+        if values:
+            return krpc.get_peers_response_values(values, token, self.self_node_id)
+        return krpc.get_peers_response_nodes(self.find_near_nodes_compact(info_hash), token, self.self_node_id)
+
+    def on_announce_peer(self, krpc: Krpc, args: dict) -> Krpc:
+        if not self.token_manager.check(krpc.sender_ip, args[b'token']):
+            return krpc.create_error_response(203, "bad token")
+
+        info_hash = args[b'info_hash']
+        port = krpc.sender_port if args.get(b'implied_port') else args[b'port']
+        if not isinstance(info_hash, bytes) or len(info_hash) != 20:
+            return krpc.create_error_response(203, "bad info_hash")
+        if not isinstance(port, int) or not 0 < port < 65536:
+            return krpc.create_error_response(203, "bad port")
+
+        self.notify_info_hash(info_hash, krpc)
+        self.peer_store.announce(info_hash, compact_peer(krpc.sender_ip, port))
+        return krpc.announce_peer_response(self.self_node_id)
+
     def process_request(self, ev: KrpcEvent):
         krpc: Krpc = ev.remote_krpc
         krpc_dict: dict = krpc.json()
         if krpc_dict.get(b'y') != b'q':
-            pass
+            return
+
+        # 过载时先丢弃路由表之外的节点发来的请求, 不回复
+        args = krpc_dict.get(b'a')
+        sender_id = args.get(b'id') if isinstance(args, dict) else None
+        known = isinstance(sender_id, bytes) and len(sender_id) == 20 and sender_id in self.seen_index
+        if not self.dispatcher.shedder.admit(Priority.HIGH if known else Priority.NORMAL):
+            return
 
         print('收到请求', krpc_dict)
-        if krpc_dict.get(b'q') == b'ping':
-            packet = krpc.ping_response()
-            self.dispatcher.send_krpc(packet, (krpc.sender_ip, krpc.sender_port))
+        method = krpc_dict.get(b'q')
+        handler = self.request_handlers.get(method) if isinstance(method, bytes) else None
+        if handler is None:
+            packet = krpc.create_error_response(204 if isinstance(method, bytes) else 203)
+        else:
+            try:
+                packet = handler(krpc, krpc_dict[b'a'])
+            except (KeyError, TypeError, ValueError) as e:
+                print(e)
+                packet = krpc.create_error_response(203)
+        self.dispatcher.send_response(packet, (krpc.sender_ip, krpc.sender_port), krpc.local_sock)
+
+    def shedding_level(self) -> int:
+        """
+        当前的过载等级, 0表示没有丢弃任何工作, 见LoadShedder
+        """
+        return self.dispatcher.shedder.level
+
+    def node_added(self, node: Node):
+        # 分裂时节点重新加入新的K桶, 已经在路由表中的节点不算新增
+        if node.node_id in self.seen_index:
+            return
+        self.seen_index.add(node)
+        self.table_feed.publish(ChangeType.ADD, node)
+
+    def node_removed(self, node: Node):
+        # 新节点直接放入caches时也会调用, 不在路由表中的节点不算移除
+        if node.node_id not in self.seen_index:
+            return
+        self.seen_index.remove(node)
+        self.table_feed.publish(ChangeType.REMOVE, node)
+
+    def node_updated(self, node: Node):
+        self.table_feed.publish(ChangeType.UPDATE, node)
+
+    def export_table(self) -> typing.Tuple[int, typing.Iterator[Node]]:
+        """
+        全量导出路由表中的节点(不包括caches), 返回(当前的table_feed序号, 节点迭代器),
+        之后用table_feed.changes_since(序号)或者订阅table_feed接收增量变化。迭代器需要在路由表变化前消费完
+        """
+        return self.table_feed.seq, (node for bucket in self.table for node in bucket.nodes.values())
+
+    def export_table_compact(self) -> typing.Tuple[int, bytes]:
+        """
+        和export_table一样, 节点为连续的26字节compact格式
+        """
+        return self.table_feed.seq, b''.join(bucket.compact_nodes() for bucket in self.table)
+
+    def node_timeout(self, krpc: KrpcRequest):
+        if krpc.node_id is None:
+            return
+        self.unresponsive.add(krpc.node_id)
+        self.lookup_cache.invalidate_node(krpc.node_id)
+        idx = self.find_bucket_index(krpc.node_id)
+        if idx >= 0:
+            self.table[idx].node_failed(krpc.node_id)
 
     def post_event(self, ev: Event or KrpcEvent):
         if ev.event_type == EventType.EVENT_TIMEOUT:
-            pass
+            self.node_timeout(ev.local_krpc)
         if ev.event_type == EventType.EVENT_REQUEST:
             self.process_request(ev)
         if ev.event_type == EventType.EVENT_RESPONSE:
@@ -397,16 +884,68 @@ class Dht(DhtBase):
                     return near_node_list[:8]
         return near_node_list
 
+    def find_near_nodes_compact(self, target_node: bytes) -> bytes:
+        """
+        和find_near_nodes一样的选择规则, 直接拼接K桶缓存的compact nodes, 不需要逐个节点编码,
+        最近查找过这个target时直接使用查找结果
+        """
+        size = 8 * 26
+        cached = self.lookup_cache.get_compact(target_node)
+        if cached is not None:
+            return cached[:size]
+
+        near_nodes = b''
+        found: bool = False
+        for bucket in self.table:
+            if bucket.in_range(target_node):
+                found = True
+
+            if found:
+                near_nodes += bucket.compact_nodes()
+                if len(near_nodes) >= size:
+                    return near_nodes[:size]
+        return near_nodes
+
     def ping_node(self, node: Node):
-        find_node_packet = self.KrpcRequest.find_node(node.node_id)
-        self.dispatcher.send_krpc(find_node_packet, node.addr(), timeout=3)
+        ping_packet = self.KrpcRequest.ping()
+        self.dispatcher.send_krpc(ping_packet, node.addr(), node_id=node.node_id, coalesce=True)
+
+    def ping_nodes(self, node_list: typing.List[Node]):
+        # 由ping_queue定时器分批发送
+        self.ping_scheduler.add(node_list)
+
+    def lookup_node(self, target_node: bytes, callback: typing.Callable or None = None,
+                    use_cache=True) -> NodeLookup:
+        lookup = NodeLookup(self, target_node, callback, use_cache=use_cache)
+        lookup.start()
+        return lookup
+
+    def get_peers(self, info_hash: bytes, on_peers: typing.Callable,
+                  callback: typing.Callable or None = None) -> GetPeersLookup:
+        """
+        :param on_peers: on_peers(peer_list), 每次发现新的peer时调用, peer是6字节的compact格式
+        :param callback: callback(lookup), 查找结束时调用, 之后可以用lookup调用announce_peer
+        """
+        lookup = GetPeersLookup(self, info_hash, on_peers, callback)
+        lookup.start()
+        return lookup
+
+    def announce_peer(self, lookup: GetPeersLookup, port: int, implied_port=False):
+        for node, token in lookup.announce_nodes():
+            packet = self.KrpcRequest.announce_peer(lookup.target, port, token, implied_port)
+            self.dispatcher.send_krpc(packet, node.addr(), node_id=node.node_id)
 
     def find_node(self, target_node: bytes):
         print(">>>>>>> in find_node", target_node.hex())
+        cached = self.lookup_cache.get(target_node)
+        if cached is not None:
+            return cached
 
         distance_min = float('inf')
         distance_cur = 1 << 160
         near_node_list: typing.List[Node] = self.find_near_nodes(target_node)
+        queried: typing.Set[bytes] = set()
+        converged = False
 
         while distance_cur < distance_min:
             print('near_node_list:')
@@ -417,8 +956,14 @@ class Dht(DhtBase):
             q = []
             node_set: typing.Set = set()
             for near_node in near_node_list:
+                # 同一次查找中已经查询过的节点不再查询
+                if near_node.node_id in queried:
+                    continue
+                queried.add(near_node.node_id)
+
                 find_node_packet = self.KrpcRequest.find_node(target_node)
-                self.dispatcher.send_krpc(find_node_packet, near_node.addr(), sync=True, timeout=2)
+                self.dispatcher.send_krpc(find_node_packet, near_node.addr(), sync=True, node_id=near_node.node_id,
+                                          coalesce=True)
                 tid = find_node_packet.transaction_id()
                 q.append(tid)
 
@@ -439,17 +984,29 @@ class Dht(DhtBase):
             sort_node_list(node_list, target_node)
             near_node_list = node_list[:16]
             distance_cur = distance_metric(near_node_list[0], target_node)
+        else:
+            converged = True
         print("find done =========")
+        # 没有收敛(没有任何响应)时的结果只是路由表中的节点, 不缓存
+        if converged:
+            self.lookup_cache.put(target_node, near_node_list[:self.K])
         return near_node_list
 
-    def find_self_node(self, node_addr_list: list, min_distance=float('+inf')):
+    def find_self_node(self, node_addr_list: list, min_distance=float('+inf'), queried: typing.Set or None = None):
         print(">>>>>>> in find_self_node")
 
+        # 同一次查找中已经查询过的地址不再查询
+        if queried is None:
+            queried = set()
         q = []
         node_set: typing.Set = set()
         for node_addr in node_addr_list:
+            if tuple(node_addr) in queried:
+                continue
+            queried.add(tuple(node_addr))
+
             find_node_packet = self.KrpcRequest.find_node(self.self_node_id)
-            self.dispatcher.send_krpc(find_node_packet, node_addr, sync=True, timeout=2)
+            self.dispatcher.send_krpc(find_node_packet, node_addr, sync=True, coalesce=True)
             tid = find_node_packet.transaction_id()
             q.append(tid)
 
@@ -491,7 +1048,7 @@ class Dht(DhtBase):
             next_addr_list.append(addr)
 
         if len(next_addr_list) > 0:
-            self.find_self_node(next_addr_list, min_distance)
+            self.find_self_node(next_addr_list, min_distance, queried)
 
     def startup_join_dht(self):
         node_list = self.get_start_node_list()
@@ -503,27 +1060,43 @@ class Dht(DhtBase):
         #     self.find_node(node_addr, self.self_node_id)
         #     # self.find_node(node_addr, random_node_id())
 
-        timer = Timer(0, lambda _: self.find_self_node(node_list), oneshot=True)
+        timer = Timer(0, lambda _: self.find_self_node(node_list), oneshot=True, name='find_self_node')
+        timer.start()
+        self.dispatcher.add_timer(timer)
+
+        timer = Timer(120, lambda x: self.update_bucket(), oneshot=False, name='update_bucket')
         timer.start()
         self.dispatcher.add_timer(timer)
 
-        timer = Timer(120, lambda x: self.update_bucket(), oneshot=False)
+        timer = Timer(10, lambda x: self.refresh_scheduler.tick(), oneshot=False, name='refresh_bucket')
         timer.start()
         self.dispatcher.add_timer(timer)
 
-        timer = Timer(60, lambda x: self.find_node(random_node_id()), oneshot=True)
+        timer = Timer(1, lambda x: self.ping_scheduler.tick(), oneshot=False, name='ping_queue')
         timer.start()
         self.dispatcher.add_timer(timer)
 
-        timer = Timer(30, lambda x: self.print_table(), oneshot=False)
+        timer = Timer(60, lambda x: self.find_node(random_node_id()), oneshot=True, name='find_random_node')
+        timer.start()
+        self.dispatcher.add_timer(timer)
+
+        timer = Timer(1, lambda x: self.peer_store.expire(), oneshot=False, name='expire_peers')
+        timer.start()
+        self.dispatcher.add_timer(timer)
+
+        timer = Timer(30, lambda x: self.print_table(), oneshot=False, name='print_table')
         timer.start()
         self.dispatcher.add_timer(timer)
 
     def update_bucket(self):
-        for bucket in self.table:
-            bucket.update_all()
+        # K桶的刷新由refresh_scheduler负责，这里只ping长时间没有活跃的节点，
+        # 连续超时的节点在node_timeout里已经被移除
+        questionable = self.seen_index.expired(time.time() - Node.INACTIVE_TIME)
+        if questionable:
+            self.ping_nodes(questionable)
 
     def run(self):
+        self.dispatcher.profiler.install_signal_handlers()
         self.startup_join_dht()
         while True:
             self.dispatcher.process_event()
@@ -566,6 +1139,45 @@ class Dht(DhtBase):
         return node_addr_list
 
 
+class DhtGroup(EventProcessor):
+    """
+    多个node_id共用一个dispatcher(同一组socket), 每个node_id有自己的路由表, 用来覆盖更多的keyspace。
+    响应和超时按照transaction id找到发出请求的Dht; 收到的请求由node_id距离查询目标最近的Dht响应
+    """
+
+    def __init__(self, local_ip, local_port, node_id_list: typing.List[bytes]):
+        self.dispatcher = EventDispatcher(self, local_ip, local_port)
+        self.dht_list: typing.List[Dht] = []
+        for node_id in node_id_list:
+            share = self.dht_list[0] if self.dht_list else None
+            self.dht_list.append(Dht(local_ip, local_port, self.dispatcher, node_id, share))
+
+    def select_dht(self, krpc: Krpc) -> Dht:
+        args = krpc.json().get(b'a')
+        if not isinstance(args, dict):
+            return self.dht_list[0]
+        target = args.get(b'target') or args.get(b'info_hash') or args.get(b'id')
+        if not isinstance(target, bytes) or len(target) != 20:
+            return self.dht_list[0]
+        return min(self.dht_list, key=lambda dht: distance_metric(dht.self_node_id, target))
+
+    def post_event(self, ev: Event or KrpcEvent):
+        if not isinstance(ev, KrpcEvent):
+            return
+        if ev.local_krpc is not None:
+            owner = ev.local_krpc.owner or self.dht_list[0]
+            owner.post_event(ev)
+        elif ev.event_type == EventType.EVENT_REQUEST:
+            self.select_dht(ev.remote_krpc).post_event(ev)
+
+    def run(self):
+        self.dispatcher.profiler.install_signal_handlers()
+        for dht in self.dht_list:
+            dht.startup_join_dht()
+        while True:
+            self.dispatcher.process_event()
+
+
 def test():
     self_id = load_self_node_id()
     print_node_id(self_id)
@@ -1,10 +1,14 @@
 import heapq
-import select
+import selectors
 import time
 import socket
 import typing
 from enum import Enum
 from krpc import Krpc, KrpcRequest
+from rate_limit import RateLimiter
+from profiler import LoopProfiler, callback_name
+from rtt import RttTable
+from overload import LoadShedder
 
 
 class EventType(Enum):
@@ -53,12 +57,13 @@ class Timer:
     def __lt__(self, other):
         return self.next < other.next
 
-    def __init__(self, timeout, callback, args=None, oneshot=True):
+    def __init__(self, timeout, callback, args=None, oneshot=True, name: str = None):
         self.timeout = timeout
         self.oneshot = oneshot
         self._callback = callback
         self.args = args
         self.next = float('+inf')
+        self.name = name or callback_name(callback)
 
     def start(self):
         self.next = self.timeout + time.time()
@@ -79,17 +84,52 @@ class Timer:
 
 class EventDispatcher:
     def __init__(self, processor: EventProcessor, local_ip, local_port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-        self.sock.bind((local_ip, local_port,))
+        self.selector = selectors.DefaultSelector()  # linux上是epoll, 每次唤醒只返回可读的socket
+        self.sock = self.add_socket(local_ip, local_port)  # 主socket, 响应从收到请求的socket发回
+        self.outbound_sock = self.sock  # 本机发起的请求使用的socket
         self.timer_list = []
         self.krpc_heap: typing.List[KrpcRequest] = []  # 本机的krpc请求，找到超时的请求
         self.krpc_dict = {}     # 本机发送的krpc请求
+        self.coalesce_dict: typing.Dict[tuple, KrpcRequest] = {}  # (owner, 方法, target, 地址) -> 还没有完成的请求
         self.wait_set = set()
         self.wait_dict = {}
         self.processor = processor
+        self.rate_limiter: RateLimiter or None = RateLimiter()
+        self.profiler = LoopProfiler()
+        self.rtt_table = RttTable()
+        self.shedder = LoadShedder()
+        self.recv_batch = 64
+        self.timeout_grace = 1.0  # 接收队列积压时请求超时最多推迟的秒数
+        self.send_dropped = 0  # 发送失败(例如发送缓冲区满)丢弃的包
 
     def __str__(self):
-        return f"EventDispatcher: len(krpc_dict):{len(self.krpc_dict)}, len(krpc_heap): {len(self.krpc_heap)}"
+        return f"EventDispatcher: len(krpc_dict):{len(self.krpc_dict)}, len(krpc_heap): {len(self.krpc_heap)}, " \
+               f"len(coalesce_dict): {len(self.coalesce_dict)}, send_dropped: {self.send_dropped}, " \
+               f"shedding level: {self.shedder.level}"
+
+    def add_socket(self, local_ip, local_port, handler: typing.Callable or None = None) -> socket.socket:
+        """
+        :param handler: handler(sock) -> Event or None, socket可读时调用, 每次读取一个包, 没有数据时抛出BlockingIOError,
+                        默认按krpc处理
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        sock.bind((local_ip, local_port,))
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, handler or self.receive_krpc)
+        return sock
+
+    def remove_socket(self, sock: socket.socket):
+        self.selector.unregister(sock)
+        sock.close()
+        if self.outbound_sock is sock:
+            self.outbound_sock = self.sock
+
+    def set_outbound_socket(self, local_ip, local_port) -> socket.socket:
+        """
+        本机发起的请求使用单独的socket, 避免和对外服务的请求互相影响
+        """
+        self.outbound_sock = self.add_socket(local_ip, local_port)
+        return self.outbound_sock
 
     def push_request(self, krpc: KrpcRequest):
         heapq.heappush(self.krpc_heap, krpc)
@@ -101,33 +141,101 @@ class EventDispatcher:
             krpc = self.krpc_dict.pop(transaction)
             return krpc
 
-    def process_event(self):
-        ev: KrpcEvent or None = None
+    def invoke(self, name: str, callback: typing.Callable, *args):
+        if self.profiler.enabled:
+            return self.profiler.call(name, callback, *args)
+        return callback(*args)
+
+    def next_wakeup(self) -> float:
+        # 下一个定时器或者请求超时的时间, 最多等待0.2秒
+        wakeup = 0.2
+        if self.timer_list:
+            wakeup = min(wakeup, self.timer_list[0].timeleft())
+        if self.krpc_heap:
+            wakeup = min(wakeup, self.krpc_heap[0].deadline - time.time())
+        return max(0, wakeup)
 
-        rl, wl, xl = select.select([self.sock], [], [], 0.2)
-        if self.sock in rl:
-            recv_packet, addr = self.sock.recvfrom(1500)
+    def process_event(self):
+        ready = self.selector.select(self.next_wakeup())
+        start = time.perf_counter()
+        backlogged = self.dispatch(ready)
+        busy = time.perf_counter() - start
+        self.shedder.update(busy, len(self.krpc_dict), backlogged)
+        if self.profiler.enabled:
+            self.profiler.record_iteration(busy)
+
+    def dispatch(self, ready: typing.List[typing.Tuple[selectors.SelectorKey, int]]) -> bool:
+        """
+        :return: 接收队列是否积压, 积压时暂停处理请求超时, 避免已经到达但还没有读取的响应被当作超时;
+                 超过截止时间timeout_grace秒的请求仍然按超时处理, 持续积压时krpc_dict不会无限增长
+        """
+        backlogged = False
+        for key, _mask in ready:
+            if self.drain(key):
+                backlogged = True
+
+        while self.timer_list and self.timer_list[0].timeleft() <= 0:
+            timer = heapq.heappop(self.timer_list)
+            if self.profiler.enabled:
+                self.profiler.record_timer_lag(-timer.timeleft())
+            self.invoke(timer.name, timer.trigger)
+            heapq.heappush(self.timer_list, timer)
+
+        cutoff = time.time() - self.timeout_grace if backlogged else time.time()
+        while self.krpc_heap and cutoff >= self.krpc_heap[0].deadline:
+            self.deliver(self.process_timeout_krpc())
+        return backlogged
+
+    def drain(self, key: selectors.SelectorKey) -> bool:
+        """
+        每次唤醒从一个socket最多读取recv_batch个包
+        :return: 读满recv_batch个包时返回True, socket中可能还有没读取的包
+        """
+        for _ in range(self.recv_batch):
+            try:
+                ev = key.data(key.fileobj)
+            except BlockingIOError:
+                return False
+            self.deliver(ev)
+        return True
+
+    def receive_krpc(self, sock: socket.socket) -> KrpcEvent or None:
+        recv_packet, addr = sock.recvfrom(1500)
+        if self.rate_limiter is not None and not self.rate_limiter.allow(addr[0]):
+            return None
+        try:
             recv_krpc = Krpc.from_bytes(recv_packet, addr[0], addr[1])
-            ev = self.process_receive_krpc(recv_krpc)
-        else:
-            while self.timer_list and self.timer_list[0].timeleft() <= 0:
-                timer = heapq.heappop(self.timer_list)
-                timer.trigger()
-                heapq.heappush(self.timer_list, timer)
+        except Exception as e:
+            print("malformed packet: ", addr, e)
+            if self.rate_limiter is not None:
+                self.rate_limiter.malformed(addr[0])
+            return None
+        recv_krpc.local_sock = sock
+        return self.process_receive_krpc(recv_krpc)
+
+    def deliver(self, ev: Event or None):
+        if ev is None:
+            return
 
-            if self.krpc_heap and time.time() >= self.krpc_heap[0].deadline:
-                ev = self.process_timeout_krpc()
+        self.invoke('post_event', self.processor.post_event, ev)
 
-        if ev is not None:
-            self.processor.post_event(ev)
+        if isinstance(ev, KrpcEvent) and ev.local_krpc:
+            request: KrpcRequest = ev.local_krpc
+            if request.coalesce_key is not None:
+                self.coalesce_dict.pop(request.coalesce_key, None)
 
-            if ev.local_krpc:
-                tid = ev.local_krpc.transaction_id()
-                if tid in self.wait_set:
-                    self.wait_dict[tid] = ev
+            self.complete_request(ev)
+            for waiter in request.waiters or ():
+                self.complete_request(KrpcEvent(ev.event_type, waiter, ev.remote_krpc))
 
-            if ev.local_krpc and ev.local_krpc.callback:
-                ev.local_krpc.callback(ev, ev.local_krpc.args)
+    def complete_request(self, ev: KrpcEvent):
+        tid = ev.local_krpc.transaction_id()
+        if tid in self.wait_set:
+            self.wait_dict[tid] = ev
+
+        if ev.local_krpc.callback:
+            callback = ev.local_krpc.callback
+            self.invoke(callback_name(callback), callback, ev, ev.local_krpc.args)
 
     def process_timeout_krpc(self) -> KrpcEvent or None:
         krpc = heapq.heappop(self.krpc_heap)
@@ -142,24 +250,63 @@ class EventDispatcher:
         t = recv_krpc.transaction_id()
         if t in self.krpc_dict.keys():
             send_rpc: KrpcRequest = self.krpc_dict.pop(t)
+            self.rtt_table.update((recv_krpc.sender_ip, recv_krpc.sender_port), time.time() - send_rpc.send_time)
             error = recv_krpc.error()
             if error is not None:
                 return KrpcEvent(EventType.EVENT_ERROR, send_rpc, recv_krpc)
             else:
                 return KrpcEvent(EventType.EVENT_RESPONSE, send_rpc, recv_krpc)
-        else:
+        elif recv_krpc.rpc[b'y'] == b'q':
             return KrpcEvent(EventType.EVENT_REQUEST, None, recv_krpc)
-
-    def send_krpc(self, krpc: KrpcRequest, sock_addr, callback=None, args=None, sync=False, timeout=5):
+        else:
+            return None  # 已经超时的请求的响应, 或者伪造的响应
+
+    def send_krpc(self, krpc: KrpcRequest, sock_addr, callback=None, args=None, sync=False, timeout=None,
+                  node_id: bytes or None = None, sock: socket.socket or None = None, coalesce=False):
+        """
+        :param timeout: 为None时根据节点的RTT估计超时时间
+        :param coalesce: 如果已经有相同的请求(身份, 方法, target, 地址都相同)还没有完成, 不再发送,
+                         等那个请求完成时把响应或者超时同样通知给这个请求
+        """
+        if timeout is None:
+            timeout = self.rtt_table.timeout(sock_addr)
         krpc.set_timeout(timeout)
         krpc.set_callback(callback, args)
+        krpc.node_id = node_id
 
         if sync:
             self.wait_set.add(krpc.transaction_id())
 
+        if coalesce:
+            key = krpc.query_key() + (tuple(sock_addr),)
+            primary = self.coalesce_dict.get(key)
+            if primary is not None:
+                if primary.waiters is None:
+                    primary.waiters = []
+                primary.waiters.append(krpc)
+                return
+            krpc.coalesce_key = key
+            self.coalesce_dict[key] = krpc
+
+        packet = krpc.bencode()
+        try:
+            (sock or self.outbound_sock).sendto(packet, sock_addr)
+        except OSError as e:  # 包括发送缓冲区满时的BlockingIOError
+            # 没有发出去的请求在下一次循环按超时处理, 查找可以继续; 不是对方的问题, 不记录节点失败
+            print("send failed: ", sock_addr, e)
+            self.send_dropped += 1
+            krpc.deadline = time.time()
+            krpc.node_id = None
         self.push_request(krpc)
+
+    def send_response(self, krpc: Krpc, sock_addr, sock: socket.socket or None = None):
+        # 响应和错误不需要等待对方回复, 不放入krpc_dict/krpc_heap
         packet = krpc.bencode()
-        self.sock.sendto(packet, sock_addr)
+        try:
+            (sock or self.sock).sendto(packet, sock_addr)
+        except OSError as e:
+            print("send failed: ", sock_addr, e)
+            self.send_dropped += 1
 
     def wait_response(self, transaction_id: bytes):
         self.wait_set.add(transaction_id)
@@ -1,11 +1,45 @@
 import time
-import random
+import secrets
+import hashlib
 import bencode
 import typing
 
 
 def gen_token() -> bytes:
-    return random.randbytes(10)
+    # 用作TokenManager的secret, 不能使用可以被预测的random模块
+    return secrets.token_bytes(10)
+
+
+class TokenManager:
+    """
+    get_peers返回的token, token = sha1(secret + ip), secret每interval秒更换一次,
+    announce_peer时当前和上一个secret生成的token都有效
+    """
+
+    def __init__(self, interval=5 * 60):
+        self.interval = interval
+        self._secret = gen_token()
+        self._prev_secret = self._secret
+        self._rotate_time = time.time()
+
+    def _rotate(self):
+        now = time.time()
+        if now - self._rotate_time >= self.interval:
+            self._prev_secret = self._secret
+            self._secret = gen_token()
+            self._rotate_time = now
+
+    @staticmethod
+    def _make_token(secret: bytes, ip: str) -> bytes:
+        return hashlib.sha1(secret + ip.encode()).digest()[:8]
+
+    def token(self, ip: str) -> bytes:
+        self._rotate()
+        return self._make_token(self._secret, ip)
+
+    def check(self, ip: str, token: bytes) -> bool:
+        self._rotate()
+        return token in (self._make_token(self._secret, ip), self._make_token(self._prev_secret, ip))
 
 
 class Krpc:
@@ -18,9 +52,10 @@ class Krpc:
 
     @classmethod
     def gen_transaction_id(cls) -> bytes:
-        cls._transactionID += 1
-        cls._transactionID %= 2**32
-        return cls._transactionID.to_bytes(4, 'big', signed=False)
+        # 多个node_id使用不同的子类, 共用一个dispatcher, transaction id必须在基类上计数, 不能重复
+        Krpc._transactionID += 1
+        Krpc._transactionID %= 2**32
+        return Krpc._transactionID.to_bytes(4, 'big', signed=False)
 
     @classmethod
     def create_request(cls, func: str, args: dict):
@@ -81,48 +116,83 @@ class Krpc:
         }
         return cls.create_request("get_peers", args)
 
-    def ping_response(self):
+    @classmethod
+    def announce_peer(cls, info_hash: bytes, port: int, token: bytes, implied_port=False):
+        args = {
+            b"id": cls._self_node_id,
+            b"info_hash": info_hash,
+            b"port": port,
+            b"token": token,
+            b"implied_port": 1 if implied_port else 0,
+        }
+        return cls.create_request("announce_peer", args)
+
+    @classmethod
+    def sample_infohashes(cls, target: bytes):
+        """
+        BEP 51
+        """
+        args = {
+            b"id": cls._self_node_id,
+            b"target": target
+        }
+        return cls.create_request("sample_infohashes", args)
+
+    def ping_response(self, node_id: bytes = None):
         data = {
-            b"id": self.__class__._self_node_id,
+            b"id": node_id or self.__class__._self_node_id,
         }
         t = self.rpc[b't']
         return self.create_response(t, data)
 
-    def find_node_response(self, nodes: bytes):
+    def find_node_response(self, nodes: bytes, node_id: bytes = None):
         data = {
-            b"id": self.__class__._self_node_id,
+            b"id": node_id or self.__class__._self_node_id,
             b"nodes": nodes,
         }
         t = self.rpc[b't']
         return self.create_response(t, data)
 
-    def get_peers_response_values(self, values: list):
+    def get_peers_response_values(self, values: list, token: bytes = None, node_id: bytes = None):
         data = {
-            b"id": self.__class__._self_node_id,
+            b"id": node_id or self.__class__._self_node_id,
             b"values": values,
-            b"token": gen_token()
+            b"token": token or gen_token()
         }
         t = self.rpc[b't']
         return self.create_response(t, data)
 
-    def get_peers_response_nodes(self, nodes: bytes):
+    def get_peers_response_nodes(self, nodes: bytes, token: bytes = None, node_id: bytes = None):
         data = {
-            b"id": self.__class__._self_node_id,
+            b"id": node_id or self.__class__._self_node_id,
             b"nodes": nodes,
-            b"token": gen_token()
+            b"token": token or gen_token()
+        }
+        t = self.rpc[b't']
+        return self.create_response(t, data)
+
+    def announce_peer_response(self, node_id: bytes = None):
+        data = {
+            b"id": node_id or self.__class__._self_node_id,
         }
         t = self.rpc[b't']
         return self.create_response(t, data)
 
+    def create_error_response(self, err_number: int, msg: str = None):
+        return self.create_error(self.rpc.get(b't', b''), err_number, msg)
+
     @staticmethod
     def from_bytes(data: bytes, sender_ip: str, sender_port: int):
         rpc = bencode.decode(data)
+        if not isinstance(rpc, dict) or not isinstance(rpc.get(b't'), bytes) or not isinstance(rpc.get(b'y'), bytes):
+            raise ValueError("invalid krpc")
         return Krpc(rpc, sender_ip, sender_port)
 
     def __init__(self, rpc: dict, sender_ip: str = None, sender_port: int = None):
         self.rpc = rpc
         self.sender_ip = sender_ip
         self.sender_port = sender_port
+        self.local_sock = None  # 收到这个包的本地socket
 
     def transaction_id(self) -> bytes:
         return self.rpc.get(b't')
@@ -144,20 +214,36 @@ class Krpc:
 
 
 class KrpcRequest(Krpc):
+    MIN_TIMEOUT = 0.2
+    owner = None  # 发出请求的Dht, 见Dht.__init__
+
     def __init__(self, rpc: dict):
         super().__init__(rpc)
+        self.send_time = 0
         self.deadline = 0
         self.callback: typing.Callable or None = None
         self.args = None
         self.response: Krpc = None
+        self.node_id: bytes or None = None  # 接收方的node_id, 超时的时候用来记录节点失败次数
+        self.coalesce_key: tuple or None = None
+        self.waiters: typing.List[KrpcRequest] or None = None  # 合并到这个请求上的相同请求
 
     def __lt__(self, other):
         return self.deadline < other.deadline
 
     def set_timeout(self, timeout=5):
-        if timeout < 1:
-            timeout = 1
-        self.deadline = time.time() + timeout
+        if timeout < self.MIN_TIMEOUT:
+            timeout = self.MIN_TIMEOUT
+        self.send_time = time.time()
+        self.deadline = self.send_time + timeout
+
+    def query_key(self) -> tuple:
+        """
+        方法和查询目标相同的请求, 发给同一个节点时得到的响应是一样的。
+        不同身份(owner)发出的请求不合并, 响应和超时只会通知给发出请求的那个Dht
+        """
+        args: dict = self.rpc.get(b'a', {})
+        return self.owner, self.rpc.get(b'q'), args.get(b'target') or args.get(b'info_hash')
 
     def set_callback(self, callback: typing.Callable, args=None):
         if not isinstance(callback, typing.Callable):
@@ -0,0 +1,72 @@
+import time
+import typing
+from collections import OrderedDict
+
+
+class LookupCache:
+    """
+    最近查找结果的缓存: target -> 查找到的最近的k个节点, 同时保存这些节点的compact格式用于直接响应请求。
+    每项ttl秒后过期, 最多max_entries项, 超出时淘汰最久没有使用的; 缓存中的节点被判定为失效时, 包含它的结果一起失效
+    """
+
+    def __init__(self, ttl=5 * 60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: typing.OrderedDict[bytes, typing.Tuple[float, list, bytes]] = OrderedDict()
+        self._node_targets: typing.Dict[bytes, typing.Set[bytes]] = {}  # node_id -> 包含这个节点的target
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return f"LookupCache(entries: {len(self._entries)}, hits: {self.hits}, misses: {self.misses})"
+
+    def put(self, target: bytes, node_list: list):
+        if not node_list:
+            return
+        self.remove(target)
+        compact = b''.join(node.to_bytes() for node in node_list)
+        self._entries[target] = (time.time() + self.ttl, node_list, compact)
+        for node in node_list:
+            self._node_targets.setdefault(node.node_id, set()).add(target)
+
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def _get(self, target: bytes):
+        entry = self._entries.get(target)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] <= time.time():
+            self.remove(target)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(target)
+        self.hits += 1
+        return entry
+
+    def get(self, target: bytes) -> list or None:
+        entry = self._get(target)
+        return entry[1] if entry is not None else None
+
+    def get_compact(self, target: bytes) -> bytes or None:
+        entry = self._get(target)
+        return entry[2] if entry is not None else None
+
+    def remove(self, target: bytes):
+        entry = self._entries.pop(target, None)
+        if entry is None:
+            return
+        for node in entry[1]:
+            targets = self._node_targets.get(node.node_id)
+            if targets is not None:
+                targets.discard(target)
+                if not targets:
+                    self._node_targets.pop(node.node_id)
+
+    def invalidate_node(self, node_id: bytes):
+        for target in list(self._node_targets.get(node_id, ())):
+            self.remove(target)
@@ -0,0 +1,55 @@
+import enum
+import typing
+
+
+class Priority(enum.IntEnum):
+    LOW = 0  # 爬虫请求, K桶刷新
+    NORMAL = 1  # 未知节点发来的请求
+    HIGH = 2  # 查找, 路由表中节点发来的请求
+
+
+class LoadShedder:
+    """
+    过载保护: 根据事件循环每次处理的耗时(指数平均)、未完成的请求数量以及接收队列是否积压计算过载等级
+    level 0: 处理所有工作; level 1: 丢弃LOW; level 2: 丢弃LOW和NORMAL, 只处理HIGH
+    """
+    MAX_LEVEL = 2
+
+    def __init__(self, lag_levels=(0.05, 0.2), inflight_levels=(5000, 20000), smoothing=0.1):
+        self.lag_levels = lag_levels
+        self.inflight_levels = inflight_levels
+        self.smoothing = smoothing
+        self.lag = 0.0
+        self.inflight = 0
+        self.backlogged = False
+        self.level = 0
+        self.shed: typing.Dict[Priority, int] = {priority: 0 for priority in Priority}
+
+    def __str__(self):
+        shed = ', '.join(f"{priority.name}: {count}" for priority, count in self.shed.items())
+        return f"LoadShedder(level: {self.level}, lag: {self.lag * 1000:.1f}ms, inflight: {self.inflight}, " \
+               f"backlogged: {self.backlogged}, shed: {shed})"
+
+    @staticmethod
+    def _level(value: float, thresholds: typing.Sequence[float]) -> int:
+        level = 0
+        for threshold in thresholds:
+            if value >= threshold:
+                level += 1
+        return level
+
+    def update(self, busy: float, inflight: int, backlogged: bool):
+        self.lag = (1 - self.smoothing) * self.lag + self.smoothing * busy
+        self.inflight = inflight
+        self.backlogged = backlogged
+
+        level = max(self._level(self.lag, self.lag_levels), self._level(inflight, self.inflight_levels))
+        if backlogged:
+            level = max(level, 1)
+        self.level = min(level, self.MAX_LEVEL)
+
+    def admit(self, priority: Priority) -> bool:
+        if priority >= self.level:
+            return True
+        self.shed[priority] += 1
+        return False
@@ -0,0 +1,126 @@
+import time
+import heapq
+import random
+import socket
+import typing
+from struct import pack
+from collections import OrderedDict
+
+
+def compact_peer(ip: str, port: int) -> bytes:
+    return socket.inet_aton(ip) + pack("!H", port)
+
+
+class PeerStore:
+    """
+    info_hash -> peers 的内存存储, peer使用6字节的compact格式(ip + port), 每个peer有自己的过期时间
+
+    所有info_hash一共最多保存max_peers个peer, 超出时从最久没有使用的info_hash开始淘汰,
+    单个info_hash最多保存max_peers_per_hash个peer, 超出时淘汰最旧的peer
+    info_hash按最早过期的peer放入小顶堆, expire只访问已经过期的部分, 过时的记录在弹出时惰性丢弃
+    """
+    MAX_VALUES = 100  # 一个UDP响应最多返回的peer数量, 100 * 8字节, 加上其他字段不超过1500字节
+
+    def __init__(self, max_peers=1000000, max_peers_per_hash=2000, ttl=30 * 60):
+        self.max_peers = max_peers
+        self.max_peers_per_hash = max_peers_per_hash
+        self.ttl = ttl
+        # info_hash按使用顺序排列, 越后面越新; 每个info_hash的peers按过期时间排列
+        self._store: typing.OrderedDict[bytes, typing.OrderedDict[bytes, float]] = OrderedDict()
+        self._count = 0
+        self._expire_heap: typing.List[typing.Tuple[float, bytes]] = []
+        self._scheduled: typing.Dict[bytes, float] = {}  # info_hash -> 堆中有效记录的时间
+
+    def __len__(self):
+        return self._count
+
+    def __str__(self):
+        return f"PeerStore(info_hash: {len(self._store)}, peers: {self._count})"
+
+    def announce(self, info_hash: bytes, peer: bytes):
+        peers = self._store.get(info_hash)
+        if peers is None:
+            peers = OrderedDict()
+            self._store[info_hash] = peers
+            self._schedule(info_hash, time.time() + self.ttl)
+        else:
+            self._store.move_to_end(info_hash)
+
+        if peer in peers:
+            peers.move_to_end(peer)
+        else:
+            self._count += 1
+        peers[peer] = time.time() + self.ttl
+
+        while len(peers) > self.max_peers_per_hash:
+            peers.popitem(last=False)
+            self._count -= 1
+
+        while self._count > self.max_peers:
+            self._evict()
+
+    def get_peers(self, info_hash: bytes, count: int = MAX_VALUES) -> typing.List[bytes]:
+        peers = self._store.get(info_hash)
+        if peers is None:
+            return []
+
+        self._expire_peers(info_hash, peers, time.time())
+        if not peers:
+            return []
+
+        self._store.move_to_end(info_hash)
+        if len(peers) > count:
+            return random.sample(list(peers.keys()), count)
+        return list(peers.keys())
+
+    def expire(self, budget=0.01) -> bool:
+        """
+        按过期时间从堆中取出已经到期的info_hash, 删除过期的peer, 直到没有到期的info_hash或者用完budget秒
+        :return: 是否已经处理完所有到期的info_hash
+        """
+        now = time.time()
+        stop = time.perf_counter() + budget
+        heap = self._expire_heap
+        processed = 0
+        while heap and heap[0][0] <= now:
+            processed += 1
+            if processed % 256 == 0 and time.perf_counter() >= stop:
+                return False
+            deadline, info_hash = heapq.heappop(heap)
+            if self._scheduled.get(info_hash) != deadline:
+                continue
+            del self._scheduled[info_hash]
+            peers = self._store[info_hash]
+            self._expire_peers(info_hash, peers, now)
+            if peers:
+                # 剩下的peer中最早过期的一个
+                self._schedule(info_hash, next(iter(peers.values())))
+        return True
+
+    def _schedule(self, info_hash: bytes, deadline: float):
+        # 每个info_hash在堆中只有一条有效记录, 时间不晚于它最早过期的peer
+        self._scheduled[info_hash] = deadline
+        heapq.heappush(self._expire_heap, (deadline, info_hash))
+        if len(self._expire_heap) > 2 * len(self._scheduled) + 64:
+            self._expire_heap = [(deadline, info_hash) for info_hash, deadline in self._scheduled.items()]
+            heapq.heapify(self._expire_heap)
+
+    def _expire_peers(self, info_hash: bytes, peers: typing.OrderedDict[bytes, float], now: float):
+        while peers:
+            peer, deadline = next(iter(peers.items()))
+            if deadline > now:
+                break
+            peers.popitem(last=False)
+            self._count -= 1
+
+        if not peers:
+            self._store.pop(info_hash, None)
+            self._scheduled.pop(info_hash, None)
+
+    def _evict(self):
+        info_hash, peers = next(iter(self._store.items()))
+        peers.popitem(last=False)
+        self._count -= 1
+        if not peers:
+            self._store.pop(info_hash)
+            self._scheduled.pop(info_hash, None)
@@ -0,0 +1,145 @@
+import time
+import heapq
+import atexit
+import signal
+import typing
+import traceback
+from collections import Counter
+
+
+def callback_name(callback: typing.Callable) -> str:
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+def callback_location(callback: typing.Callable) -> str:
+    code = getattr(callback, '__code__', None) or getattr(getattr(callback, '__func__', None), '__code__', None)
+    if code is None:
+        return repr(callback)
+    return f"{code.co_filename}:{code.co_firstlineno}"
+
+
+class LoopProfiler:
+    """
+    事件循环的性能统计, 默认关闭, 关闭时dispatcher每次回调只多一次enabled的判断。
+    打开后记录: 每次循环处理事件花费的时间(循环延迟), 定时器的触发延迟, 每个回调的耗时, 以及最慢的top_n次回调和它们的调用栈。
+    采样profiler用ITIMER_PROF定时采样调用栈, 慢回调的调用栈取这次回调期间最后一次采样, 没有采样时使用回调函数的位置。
+
+    kill -USR1 <pid> 打开/关闭统计和采样, kill -USR2 <pid> 打印报告
+    """
+
+    def __init__(self, top_n=10, slow_threshold=0.05, sample_interval=0.005):
+        self.enabled = False
+        self.top_n = top_n
+        self.slow_threshold = slow_threshold
+        self.sample_interval = sample_interval
+        self.reset()
+
+    def reset(self):
+        self.stats: typing.Dict[str, typing.List] = {}  # name -> [次数, 总耗时, 最大耗时]
+        self.slowest: typing.List[typing.Tuple[float, str, str]] = []  # 小顶堆 (耗时, name, 调用栈)
+        self.iterations = 0
+        self.busy_total = 0.0
+        self.busy_max = 0.0
+        self.timer_lag_max = 0.0
+        self.samples: typing.Counter[str] = Counter()
+        self.sampling = False
+        self._current_stack: str or None = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.stop_sampling()
+
+    def record_iteration(self, busy: float):
+        self.iterations += 1
+        self.busy_total += busy
+        if busy > self.busy_max:
+            self.busy_max = busy
+
+    def record_timer_lag(self, lag: float):
+        if lag > self.timer_lag_max:
+            self.timer_lag_max = lag
+
+    def call(self, name: str, callback: typing.Callable, *args):
+        outer_stack = self._current_stack
+        self._current_stack = None
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            duration = time.perf_counter() - start
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += duration
+            if duration > stat[2]:
+                stat[2] = duration
+
+            if duration >= self.slow_threshold and (len(self.slowest) < self.top_n or duration > self.slowest[0][0]):
+                stack = self._current_stack or callback_location(callback)
+                if len(self.slowest) < self.top_n:
+                    heapq.heappush(self.slowest, (duration, name, stack))
+                else:
+                    heapq.heapreplace(self.slowest, (duration, name, stack))
+            self._current_stack = outer_stack
+
+    def _on_sample(self, signum, frame):
+        stack = ''.join(traceback.format_stack(frame, limit=20))
+        self.samples[stack] += 1
+        self._current_stack = stack
+
+    def start_sampling(self):
+        if self.sampling:
+            return
+        signal.signal(signal.SIGPROF, self._on_sample)
+        signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+        self.sampling = True
+        atexit.register(self.stop_sampling)
+
+    def stop_sampling(self):
+        if not self.sampling:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.sampling = False
+        atexit.unregister(self.stop_sampling)
+
+    def toggle(self, *_):
+        if self.enabled:
+            self.disable()
+            print(self.report())
+        else:
+            self.reset()
+            self.enable()
+            self.start_sampling()
+
+    def install_signal_handlers(self):
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        signal.signal(signal.SIGUSR1, self.toggle)
+        signal.signal(signal.SIGUSR2, lambda *_: print(self.report()))
+
+    def report(self) -> str:
+        lines = ["[profiler]==========================="]
+        busy_avg = self.busy_total / self.iterations if self.iterations else 0
+        lines.append(f"iterations: {self.iterations}, busy avg: {busy_avg * 1000:.3f}ms, "
+                     f"busy max: {self.busy_max * 1000:.3f}ms, timer lag max: {self.timer_lag_max * 1000:.3f}ms")
+
+        lines.append("callbacks (count, total, max):")
+        for name, (count, total, max_time) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append(f"  {name}: {count}, {total * 1000:.3f}ms, {max_time * 1000:.3f}ms")
+
+        lines.append(f"slowest {len(self.slowest)}:")
+        for duration, name, stack in sorted(self.slowest, reverse=True):
+            lines.append(f"  {name}: {duration * 1000:.3f}ms")
+            lines.append(stack)
+
+        if self.samples:
+            lines.append("top sampled stacks:")
+            for stack, count in self.samples.most_common(5):
+                lines.append(f"  samples: {count}")
+                lines.append(stack)
+        return '\n'.join(lines)
@@ -0,0 +1,121 @@
+import time
+import random
+import typing
+from collections import OrderedDict
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._stamp = time.time()
+
+    def allow(self, n=1) -> bool:
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class TokenBucketSketch:
+    """
+    近似的按key限流: depth行width列的令牌桶数组(类似count-min sketch), 每个key在每一行哈希到一个令牌桶,
+    可用令牌取所有行中的最小值。内存固定, 伪造源地址的洪水不会让内存增长, 代价是少量key因为哈希冲突被误限流
+    """
+
+    def __init__(self, rate: float, burst: float, width=4096, depth=3):
+        self.rate = rate
+        self.burst = burst
+        self.width = width
+        self._seeds = [random.getrandbits(32) for _ in range(depth)]
+        self._tokens = [[float(burst)] * width for _ in range(depth)]
+        self._stamps = [[0.0] * width for _ in range(depth)]
+
+    def allow(self, key, now: float = None) -> bool:
+        now = now or time.time()
+        cells = []
+        min_tokens = self.burst
+        for row, seed in enumerate(self._seeds):
+            col = hash((seed, key)) % self.width
+            tokens = self._tokens[row][col] + (now - self._stamps[row][col]) * self.rate
+            tokens = min(tokens, self.burst)
+            self._tokens[row][col] = tokens
+            self._stamps[row][col] = now
+            min_tokens = min(min_tokens, tokens)
+            cells.append(col)
+
+        if min_tokens < 1:
+            return False
+
+        for row, col in enumerate(cells):
+            self._tokens[row][col] -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    入站包的限流, 在收包之后、解码之前检查:
+    每个ip和每个/24网段各有一个令牌桶, 超出限制的包直接丢弃;
+    持续超出限制或者发送错误格式包的ip, 会被加入自动过期的黑名单
+    """
+
+    def __init__(self, ip_rate=20, ip_burst=50, net_rate=100, net_burst=200,
+                 strike_rate=0.5, max_strikes=20, block_time=10 * 60, max_blocked=10000):
+        self.ip_bucket = TokenBucketSketch(ip_rate, ip_burst)
+        self.net_bucket = TokenBucketSketch(net_rate, net_burst)
+        self.strike_bucket = TokenBucketSketch(strike_rate, max_strikes)  # 违规次数也用令牌桶计数, 随时间恢复
+        self.block_time = block_time
+        self.max_blocked = max_blocked
+        self.blocked: typing.OrderedDict[str, float] = OrderedDict()  # ip -> 解除时间, 越后面越晚解除
+        self.dropped = 0
+
+    def __str__(self):
+        return f"RateLimiter(blocked: {len(self.blocked)}, dropped: {self.dropped})"
+
+    def is_blocked(self, ip: str, now: float) -> bool:
+        deadline = self.blocked.get(ip)
+        if deadline is None:
+            return False
+        if deadline <= now:
+            self.blocked.pop(ip)
+            return False
+        return True
+
+    def block(self, ip: str, now: float):
+        self.blocked[ip] = now + self.block_time
+        self.blocked.move_to_end(ip)
+        while self.blocked:
+            oldest_ip, deadline = next(iter(self.blocked.items()))
+            if deadline > now and len(self.blocked) <= self.max_blocked:
+                break
+            self.blocked.popitem(last=False)
+
+    def strike(self, ip: str, now: float = None):
+        now = now or time.time()
+        if not self.strike_bucket.allow(ip, now):
+            print("block ip: ", ip)
+            self.block(ip, now)
+
+    def allow(self, ip: str) -> bool:
+        now = time.time()
+        if self.is_blocked(ip, now):
+            self.dropped += 1
+            return False
+
+        if not self.ip_bucket.allow(ip, now):
+            self.dropped += 1
+            self.strike(ip, now)
+            return False
+
+        net = ip.rsplit('.', 1)[0]
+        if not self.net_bucket.allow(net, now):
+            self.dropped += 1
+            return False
+        return True
+
+    def malformed(self, ip: str):
+        self.strike(ip)
@@ -0,0 +1,71 @@
+import typing
+from collections import OrderedDict
+
+
+class RttEstimator:
+    """
+    RFC 6298的平滑RTT估计: srtt和rttvar, 超时时间 rto = srtt + 4 * rttvar
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    __slots__ = ('srtt', 'rttvar')
+
+    def __init__(self, sample: float):
+        self.srtt = sample
+        self.rttvar = sample / 2
+
+    def update(self, sample: float):
+        self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+        self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+
+    def rto(self) -> float:
+        return self.srtt + 4 * self.rttvar
+
+
+class RttTable:
+    """
+    按节点地址保存RttEstimator, 最多保存max_nodes个, 超出时淘汰最久没有更新的。
+    没有记录的节点的rtt使用所有响应汇总的全局估计; 超时时间只有节点自己的估计可以缩短,
+    没有记录的节点使用default_timeout, 全局估计更大时使用全局估计
+    """
+
+    def __init__(self, max_nodes=100000, min_timeout=0.5, max_timeout=5, default_timeout=2):
+        self.max_nodes = max_nodes
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.default_timeout = default_timeout
+        self._nodes: typing.OrderedDict[tuple, RttEstimator] = OrderedDict()
+        self._global: RttEstimator or None = None
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def update(self, addr: tuple, sample: float):
+        estimator = self._nodes.get(addr)
+        if estimator is None:
+            self._nodes[addr] = RttEstimator(sample)
+            if len(self._nodes) > self.max_nodes:
+                self._nodes.popitem(last=False)
+        else:
+            estimator.update(sample)
+            self._nodes.move_to_end(addr)
+
+        if self._global is None:
+            self._global = RttEstimator(sample)
+        else:
+            self._global.update(sample)
+
+    def _estimator(self, addr: tuple) -> RttEstimator or None:
+        return self._nodes.get(addr) or self._global
+
+    def rtt(self, addr: tuple) -> float:
+        estimator = self._estimator(addr)
+        return estimator.srtt if estimator is not None else self.default_timeout
+
+    def timeout(self, addr: tuple) -> float:
+        estimator = self._nodes.get(addr)
+        if estimator is not None:
+            return min(self.max_timeout, max(self.min_timeout, estimator.rto()))
+        if self._global is None:
+            return self.default_timeout
+        return min(self.max_timeout, max(self.default_timeout, self._global.rto()))
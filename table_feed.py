@@ -0,0 +1,72 @@
+import enum
+import typing
+from struct import pack
+from collections import deque
+
+
+class ChangeType(enum.IntEnum):
+    ADD = 0
+    UPDATE = 1
+    REMOVE = 2
+
+
+class TableChange:
+    __slots__ = ('seq', 'change_type', 'node')
+
+    def __init__(self, seq: int, change_type: ChangeType, node):
+        self.seq = seq
+        self.change_type = change_type
+        self.node = node
+
+    def __str__(self):
+        return f"TableChange(seq: {self.seq}, {self.change_type.name}, {self.node})"
+
+    def to_bytes(self) -> bytes:
+        # 1字节类型 + 8字节序号 + 26字节compact节点
+        return pack('!BQ', self.change_type, self.seq) + self.node.to_bytes()
+
+
+class TableFeed:
+    """
+    路由表的增量变化: 节点进入nodes(ADD), 已经在nodes中的节点活跃或者失败一次(UPDATE), 节点离开nodes(REMOVE)。
+    每次变化分配递增的序号, 保存最近max_changes条; 订阅者通过subscribe实时接收, 或者用changes_since拉取。
+    先用Dht.export_table得到全量和当时的序号, 再从这个序号开始接收变化, 即可保持同步
+    """
+
+    def __init__(self, max_changes=10000):
+        self.seq = 0
+        self._changes: typing.Deque[TableChange] = deque(maxlen=max_changes)
+        self._listeners: typing.List[typing.Callable] = []
+
+    def __str__(self):
+        return f"TableFeed(seq: {self.seq}, changes: {len(self._changes)}, listeners: {len(self._listeners)})"
+
+    def subscribe(self, listener: typing.Callable):
+        """
+        :param listener: listener(change: TableChange)
+        """
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: typing.Callable):
+        self._listeners.remove(listener)
+
+    def publish(self, change_type: ChangeType, node):
+        self.seq += 1
+        change = TableChange(self.seq, change_type, node)
+        self._changes.append(change)
+        for listener in self._listeners:
+            try:
+                listener(change)
+            except Exception as e:
+                print(e)
+
+    def changes_since(self, seq: int) -> typing.List[TableChange] or None:
+        """
+        返回序号大于seq的变化, 需要的变化已经被丢弃时返回None, 调用方需要重新全量导出
+        """
+        if seq >= self.seq:
+            return []
+        if not self._changes or self._changes[0].seq > seq + 1:
+            return None
+        start = len(self._changes) - (self.seq - seq)
+        return [self._changes[i] for i in range(start, len(self._changes))]